@@ -3,19 +3,45 @@
 import subprocess
 import sys
 import os
+import re
+import json
 import shlex
 import getpass
+import hmac
 import shutil
+import signal
+import tempfile
+import stat
 import time
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Tuple
+
+try:
+    import btrfsutil # Python bindings shipped with btrfs-progs
+except ImportError:
+    btrfsutil = None
 
 # Configuration variables
-default_packages = [
+pacman_parallel_downloads = 5
+# Only used for the pacstrap run itself; the live /etc/pacman.conf is left untouched
+pacstrap_parallel_downloads = 10
+
+default_packages = (
     "base", "linux", "linux-firmware", "btrfs-progs", "nano", "sudo",
     "networkmanager", "efibootmgr", "grub", "os-prober", "base-devel", "git"
+)
+
+required_tools = [
+    "lsblk", "mount", "umount", "fuser", "mkfs.btrfs", "mkfs.fat", "btrfs",
+    "btrfstune", "pacstrap", "arch-chroot", "genfstab"
 ]
 
+_device_path_re = re.compile(r"/dev/[A-Za-z0-9/_.:-]+")
+
 @dataclass
 class InstallConfig:
     seed_device: str
@@ -24,15 +50,37 @@ class InstallConfig:
     hostname: str = "arch-z"
     username: str = "zeev"
     timezone: str = "Europe/Helsinki"
-    root_password: str = ""
-    user_password: str = ""
-    packages: List[str] = field(default_factory=lambda: list(default_packages))
+    root_password: bytearray = field(default_factory=bytearray)
+    user_password: bytearray = field(default_factory=bytearray)
+    packages: Tuple[str, ...] = default_packages
     dry_run: bool = False
     format_efi: bool = True
+    parallel_mkfs: bool = True
     bootloader_id: str = "GRUB"
 
-def run_command(command, check=True, shell=False, capture_output=False, dry_run=False):
-# ... (existing run_command code)
+    def __post_init__(self):
+        # Device paths end up in argv lists and scripts, so only accept plain /dev paths
+        for name in ("seed_device", "sprout_device", "efi_device"):
+            if not _device_path_re.fullmatch(getattr(self, name)):
+                raise ValueError(f"Invalid {name}: {getattr(self, name)!r}")
+
+# Absolute paths of external tools, resolved once
+TOOLS = {}
+
+def tool(name):
+    """Returns the absolute path of an external tool, resolving it via PATH on first use."""
+    if name not in TOOLS:
+        TOOLS[name] = shutil.which(name) or name
+    return TOOLS[name]
+
+def run_command(command, check=True, capture_output=False, dry_run=False):
+    """Runs a command (argv list) and returns the CompletedProcess."""
+    if dry_run:
+        print(f"[DRY RUN] Would execute: {' '.join(command)}")
+        return subprocess.CompletedProcess(command, 0, stdout="", stderr="")
+
+    try:
+        return subprocess.run(command, check=check, capture_output=capture_output, text=True)
     except subprocess.CalledProcessError as e:
         print(f"Error executing command: {command}")
         print(f"Error output: {e.stderr}")
@@ -40,45 +88,447 @@ def run_command(command, check=True, shell=False, capture_output=False, dry_run=
             sys.exit(1)
         return e
 
+def spawn_run(argv, check=True, quiet=False):
+    """
+    Runs a short-lived command via os.posix_spawn, with no pipes or output capture.
+    quiet=True discards stderr. Returns the exit code; raises CalledProcessError on failure if check is set.
+    """
+    file_actions = [(os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0)] if quiet else None
+    pid = os.posix_spawnp(tool(argv[0]), argv, os.environ, file_actions=file_actions)
+    _, status = os.waitpid(pid, 0)
+    rc = os.waitstatus_to_exitcode(status)
+    if check and rc != 0:
+        raise subprocess.CalledProcessError(rc, argv)
+    return rc
+
+def sh_out(argv):
+    """Runs a short query command and returns its stdout. Raises CalledProcessError on failure."""
+    return subprocess.run(argv, check=True, text=True, capture_output=True).stdout
+
+_disks_cache = None
+_ignored_disk_re = re.compile(r"/dev/(dm-|md|loop|ram|zram|sr)")
+
+def human_size(num_bytes):
+    """Formats a byte count the way lsblk does (e.g. 512M, 931.5G)."""
+    for unit in "BKMGTP":
+        if num_bytes < 1024 or unit == "P":
+            break
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}".rstrip("0").rstrip(".") + unit
+
+def _read_sysfs(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        if default is None:
+            raise
+        return default
+
+def _sysfs_disks():
+    names, sizes, models = [], [], []
+    with os.scandir("/sys/block") as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            name = f"/dev/{entry.name}"
+            # Virtual devices have no backing `device` link
+            if _ignored_disk_re.match(name) or not os.path.exists(os.path.join(entry.path, "device")):
+                continue
+            names.append(name)
+            sizes.append(human_size(int(_read_sysfs(os.path.join(entry.path, "size"))) * 512))
+            models.append(_read_sysfs(os.path.join(entry.path, "device", "model"), default=""))
+    return names, sizes, models
+
+_lsblk_cache = None
+_lsblk_index = {}
+
+def load_block_topology():
+    """
+    Loads the whole disk/partition tree with a single `lsblk -J` call.
+    Cached for the lifetime of the process (the layout doesn't change during setup),
+    with every device also indexed by path in _lsblk_index.
+    """
+    global _lsblk_cache
+    if _lsblk_cache is None:
+        output = sh_out([tool("lsblk"), "-J", "-p", "-b", "-o", "NAME,PATH,SIZE,MODEL,TYPE,PARTUUID"])
+        _lsblk_cache = json.loads(output)
+        for d in _lsblk_cache["blockdevices"]:
+            _lsblk_index[d["path"]] = d
+            for c in d.get("children", []):
+                _lsblk_index[c["path"]] = c
+    return _lsblk_cache
+
+def _lsblk_disks():
+    names, sizes, models = [], [], []
+    for d in load_block_topology()["blockdevices"]:
+        if d["type"] != "disk" or _ignored_disk_re.match(d["path"]):
+            continue
+        names.append(d["path"])
+        sizes.append(human_size(int(d["size"])))
+        models.append((d.get("model") or "").strip())
+    return names, sizes, models
+
+def _lsblk_partitions(disk):
+    load_block_topology()
+    d = _lsblk_index.get(disk, {})
+    return [{"path": c["path"], "display": f"{c['path']} ({human_size(int(c['size']))})"}
+            for c in d.get("children", []) if c["type"] == "part"]
+
+def get_disk_columns():
+    """
+    Returns installable disks as three parallel lists: (names, sizes, models).
+    Read from the cached lsblk topology (sysfs as a fallback);
+    optical and virtual devices (dm, md, loop, ram, zram) are skipped.
+    """
+    global _disks_cache
+    if _disks_cache is None:
+        try:
+            _disks_cache = _lsblk_disks()
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            _disks_cache = _sysfs_disks()
+    return _disks_cache
+
 def get_disks():
-# ... (existing get_disks)
-    return disks
+    """Returns installable disks as a list of {'name', 'size', 'model', 'raw'} dicts."""
+    return [{"name": name, "size": size, "model": model, "raw": f"{name} {size} {model}".rstrip()}
+            for name, size, model in zip(*get_disk_columns())]
+
+def _sysfs_partitions(disk):
+    disk_dir = os.path.join("/sys/block", os.path.basename(os.path.realpath(disk)))
+    parts = []
+    with os.scandir(disk_dir) as it:
+        for entry in it:
+            # Partitions are the subdirectories that carry a `partition` number file
+            number = _read_sysfs(os.path.join(entry.path, "partition"), default="")
+            if not number:
+                continue
+            path = f"/dev/{entry.name}"
+            size = human_size(int(_read_sysfs(os.path.join(entry.path, "size"))) * 512)
+            parts.append((int(number), {"path": path, "display": f"{path} ({size})"}))
+    return [p for _, p in sorted(parts, key=lambda p: p[0])]
 
 def get_partitions(disk):
-# ... (existing get_partitions)
-    return parts
+    """
+    Returns the partitions of disk as a list of {'path', 'display'} dicts.
+    Read from the cached lsblk topology, falling back to sysfs.
+    """
+    try:
+        return _lsblk_partitions(disk)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return _sysfs_partitions(disk)
+
+_partuuid_cache = {}
+
+def partuuid_from_udev(dev):
+    """
+    Reads the PARTUUID of dev straight from the udev database (/run/udev/data).
+    Returns None if udev has no entry for it yet.
+    """
+    st = os.stat(dev)
+    try:
+        with open(f"/run/udev/data/b{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}") as f:
+            for line in f:
+                if line.startswith("E:ID_PART_ENTRY_UUID="):
+                    return line.split("=", 1)[1].strip()
+    except OSError:
+        pass
+    return None
+
+def partuuid(dev):
+    """
+    Returns the PARTUUID of dev. Uses the already loaded lsblk tree if available,
+    then the udev database, then a direct lsblk query. Results are cached per device path.
+    """
+    if dev not in _partuuid_cache:
+        uuid = _lsblk_index.get(dev, {}).get("partuuid")
+        if uuid is None:
+            uuid = partuuid_from_udev(dev)
+        if uuid is None:
+            # udev may still be processing a freshly changed device
+            spawn_run(["udevadm", "settle"], check=False)
+            uuid = partuuid_from_udev(dev)
+        if uuid is None:
+            uuid = sh_out([tool("lsblk"), "-no", "PARTUUID", dev]).strip()
+        _partuuid_cache[dev] = uuid
+    return _partuuid_cache[dev]
+
+_efi_scan_cache = {}
 
 def scan_efi_bootloaders(device):
     """
-    Mounts the given device temporarily to check /EFI/ subdirectories.
+    Mounts the given device temporarily (read-only) to check /EFI/ subdirectories.
     Returns a list of directory names found (potential bootloader IDs).
+    Results are cached per device, so revisiting the screen doesn't mount again.
     """
     if not device:
         return []
+    if device in _efi_scan_cache:
+        return _efi_scan_cache[device]
 
     # Temporary mount point
     tmp_mnt = "/tmp/z_efi_check"
     os.makedirs(tmp_mnt, exist_ok=True)
     
-    # Mount
+    # Mount read-only; noatime keeps the scan from dirtying the filesystem
     try:
-        subprocess.run(f"mount {device} {tmp_mnt}", shell=True, check=True, stderr=subprocess.DEVNULL)
+        subprocess.run(["mount", "-o", "ro,noatime,nosuid,nodev", device, tmp_mnt],
+                       check=True, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError:
         return [] # Failed to mount (maybe not formatted yet)
 
     found = []
-    efi_path = os.path.join(tmp_mnt, "EFI")
-    if os.path.exists(efi_path) and os.path.isdir(efi_path):
-        try:
-             found = [d for d in os.listdir(efi_path) if os.path.isdir(os.path.join(efi_path, d))]
-        except OSError:
-             pass
+    try:
+        # scandir's is_dir() uses the dirent type, no extra stat per entry
+        with os.scandir(os.path.join(tmp_mnt, "EFI")) as it:
+            found = [e.name for e in it if e.is_dir(follow_symlinks=False)]
+    except OSError:
+        pass # No EFI directory
     
     # Unmount
-    subprocess.run(f"umount {tmp_mnt}", shell=True)
+    subprocess.run(["umount", tmp_mnt])
+    _efi_scan_cache[device] = found
     return found
 
-# ... (existing run_live_command, check_dependencies, cleanup_mount)
+def run_live_command(command, log_func=print, check=True, dry_run=False, background=False, input=None):
+    """
+    Runs a command (argv list) and streams its combined stdout/stderr to log_func line by line.
+    input (bytes) is written to the command's stdin, which is then closed.
+    With background=True the command is started and (process, reader_thread) is returned
+    immediately; pass it to wait_live_command() to collect the result.
+    Exits on failure if check is set.
+    """
+    if dry_run:
+        log_func(f"[DRY RUN] Would execute: {' '.join(command)}")
+        return None if background else 0
+
+    # Background commands get their own process group so stop_live_command() can reach their children
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, bufsize=1,
+                               stdin=subprocess.PIPE if input is not None else None,
+                               start_new_session=background)
+    if input is not None:
+        process.stdin.buffer.write(input)
+        process.stdin.close()
+
+    def pump():
+        for line in process.stdout:
+            log_func(line.rstrip("\n"))
+
+    if background:
+        reader = threading.Thread(target=pump, daemon=True)
+        reader.start()
+        return process, reader
+
+    pump()
+    return _check_live_result(command, process.wait(), log_func, check)
+
+def wait_live_command(handle, log_func=print, check=True):
+    """Waits for a command started with run_live_command(..., background=True)."""
+    if handle is None:
+        return 0
+    process, reader = handle
+    reader.join()
+    return _check_live_result(process.args, process.wait(), log_func, check)
+
+def stop_live_command(handle, log_func=print):
+    """Terminates a command started with run_live_command(..., background=True) and reaps it."""
+    if handle is None:
+        return
+    process, reader = handle
+    if process.poll() is None:
+        log_func(f"Stopping {process.args[0]}...")
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+    reader.join()
+
+def _check_live_result(command, returncode, log_func, check):
+    if returncode != 0:
+        log_func(f"Error executing command: {command} (exit code {returncode})")
+        if check:
+            sys.exit(1)
+    return returncode
+
+def check_dependencies(log_func=print):
+    """
+    Verifies that all required tools are installed and caches their absolute paths in TOOLS.
+    Raises RuntimeError listing any missing tools.
+    """
+    missing = []
+    for t in required_tools:
+        path = shutil.which(t)
+        if path:
+            TOOLS[t] = path
+        else:
+            missing.append(t)
+
+    if missing:
+        log_func(f"Error: Missing required tools: {', '.join(missing)}")
+        raise RuntimeError(f"Missing required tools: {', '.join(missing)}")
+
+def cleanup_mount(mount_point, log_func=print, mounts=None):
+    """
+    Recursively unmounts mount_point. If it is busy, kills the processes using it and retries.
+    mounts is an optional list from mounts_under(mount_point); if given, those are unmounted
+    in reverse order by a single umount call instead of umount -R walking the table again.
+    Returns True on success.
+    """
+    first = ["umount"] + mounts[::-1] if mounts else ["umount", "-R", mount_point]
+    if spawn_run(first, check=False, quiet=True) == 0:
+        return True
+
+    log_func(f"{mount_point} is busy. Killing processes using it...")
+    spawn_run(["fuser", "-k", "-m", mount_point], check=False, quiet=True)
+
+    # Retry with exponential backoff instead of a fixed sleep; killed processes usually exit within milliseconds
+    deadline = time.monotonic() + 1.0
+    delay = 0.01
+    while time.monotonic() < deadline:
+        if spawn_run(["umount", "-R", mount_point], check=False, quiet=True) == 0:
+            return True
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+    log_func(f"Warning: Failed to unmount {mount_point}")
+    return False
+
+def _uses_path(pid, path):
+    """True if process pid has its root or working directory under path."""
+    for link in ("root", "cwd"):
+        try:
+            target = os.readlink(f"/proc/{pid}/{link}")
+        except OSError:
+            continue  # Process exited or is not ours to inspect
+        if target == path or target.startswith(path + "/"):
+            return True
+    return False
+
+def wait_for_chroot_exit(path, timeout=5.0):
+    """
+    Polls /proc until no process has its root or working directory under path,
+    or timeout expires. Returns True if the chroot drained in time.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        if not any(_uses_path(pid, path) for pid in os.listdir("/proc") if pid.isdigit()):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+def run_parallel(jobs, log_func=print, dry_run=False, parallel=True):
+    """
+    Runs independent commands concurrently.
+    jobs is a list of (tag, argv) pairs; output is streamed live with a [tag] prefix on every line.
+    Worker threads only queue lines, log_func is always called from the calling thread.
+    With parallel=False the commands run one at a time, in order.
+    Exits if any command fails.
+    """
+    if dry_run:
+        for tag, cmd in jobs:
+            log_func(f"[DRY RUN] Would execute: {' '.join(cmd)}")
+        return
+
+    lines = queue.Queue()
+
+    def _run(tag, cmd):
+        try:
+            lines.put(f"[{tag}] $ {' '.join(cmd)}")
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for line in process.stdout:
+                lines.put(f"[{tag}] {line.rstrip()}")
+            return process.wait()
+        finally:
+            lines.put(None) # Marks this job as finished
+
+    with ThreadPoolExecutor(max_workers=len(jobs) if parallel else 1) as pool:
+        futures = [(cmd, pool.submit(_run, tag, cmd)) for tag, cmd in jobs]
+        finished = 0
+        while finished < len(jobs):
+            line = lines.get()
+            if line is None:
+                finished += 1
+            else:
+                log_func(line)
+
+    failed = False
+    for cmd, future in futures:
+        if future.result() != 0:
+            log_func(f"Error executing command: {' '.join(cmd)}")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+def enable_pacman_parallel(path, downloads=pacman_parallel_downloads, dest=None):
+    """
+    Enables ParallelDownloads (plus Color and ILoveCandy) in the given pacman.conf.
+    The result is written to dest if given, otherwise back to path.
+    """
+    with open(path) as f:
+        conf = f.read()
+
+    conf, found = re.subn(r"^#?\s*ParallelDownloads\s*=.*$", f"ParallelDownloads = {downloads}", conf, flags=re.M)
+    if not found:
+        conf = re.sub(r"^\[options\]$", f"[options]\nParallelDownloads = {downloads}", conf, count=1, flags=re.M)
+
+    conf = re.sub(r"^#\s*Color$", "Color", conf, flags=re.M)
+    if not re.search(r"^ILoveCandy$", conf, flags=re.M):
+        conf = re.sub(r"^Color$", "Color\nILoveCandy", conf, count=1, flags=re.M)
+
+    with open(dest or path, "w") as f:
+        f.write(conf)
+
+def shell_script(steps):
+    """
+    Builds a `set -euo pipefail` bash script from a list of steps.
+    An argv list becomes a properly quoted command line; a plain string is echoed as a log message.
+    """
+    lines = ["set -euo pipefail"]
+    for step in steps:
+        if isinstance(step, str):
+            lines.append(f"echo {shlex.quote(step)}")
+        else:
+            lines.append(shlex.join(step))
+    return "\n".join(lines)
+
+def rewrite_file(path, pattern, repl):
+    """In-place regex substitution on a file (Python equivalent of `sed -i`)."""
+    with open(path) as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(re.sub(pattern, repl, text, flags=re.M))
+
+def write_file(path, text, mode=None):
+    """Writes text to path, optionally setting its permission bits."""
+    with open(path, "w") as f:
+        f.write(text)
+    if mode is not None:
+        os.chmod(path, mode)
+
+def write_target_config(config, root):
+    """
+    Writes the static configuration of the new system under root from the host side,
+    so none of these edits need a process inside the chroot.
+    """
+    etc = os.path.join(root, "etc")
+    mkinitcpio_hooks = "base udev autodetect microcode modconf kms keyboard block btrfs filesystems"
+
+    write_file(f"{etc}/hostname", f"{config.hostname}\n")
+    write_file(f"{etc}/vconsole.conf", "KEYMAP=us\n")
+    write_file(f"{etc}/locale.conf", "LANG=en_US.UTF-8\n")
+    rewrite_file(f"{etc}/locale.gen", r"^#en_US\.UTF-8 UTF-8", "en_US.UTF-8 UTF-8")
+
+    localtime = f"{etc}/localtime"
+    if os.path.lexists(localtime):
+        os.remove(localtime)
+    os.symlink(f"/usr/share/zoneinfo/{config.timezone}", localtime)
+
+    rewrite_file(f"{etc}/mkinitcpio.conf", r"^HOOKS=.*", f"HOOKS=({mkinitcpio_hooks})")
+    write_file(f"{etc}/sudoers.d/{config.username}", f"{config.username} ALL=(ALL:ALL) ALL\n", mode=0o440)
+
+    with open(f"{etc}/default/grub", "a") as f:
+        f.write("GRUB_DISABLE_OS_PROBER=false\n")
 
 def perform_installation(config: InstallConfig, log_func=print):
     """
@@ -92,18 +542,8 @@ def perform_installation(config: InstallConfig, log_func=print):
         # If check fails, we stop. In TUI this will define the error.
         return
 
-    # helper for dry_run propagation
-    def run(cmd, **kwargs):
-        # Merge dry_run into kwargs if not explicitly set
-        if 'dry_run' not in kwargs:
-            kwargs['dry_run'] = config.dry_run
-            
-        # If capturing output, we use the standard run_command (buffered)
-        if kwargs.get('capture_output'):
-            return run_command(cmd, **kwargs)
-        
-        # Otherwise, use live command for streaming logs
-        return run_live_command(cmd, log_func=log_func, **kwargs)
+    # Every command here streams its output, so bind log_func and dry_run once
+    live = functools.partial(run_live_command, log_func=log_func, dry_run=config.dry_run)
 
     log_func("--- Starting Installation ---")
     
@@ -111,108 +551,159 @@ def perform_installation(config: InstallConfig, log_func=print):
     if config.dry_run:
         sprout_partuuid = "DRY-RUN-UUID-1234"
     else:
-        cmd_uuid = f"blkid -s PARTUUID -o value {config.sprout_device}"
-        sprout_partuuid = run(cmd_uuid, shell=True, capture_output=True).stdout.strip()
+        sprout_partuuid = partuuid(config.sprout_device)
     
     log_func(f"Sprout PARTUUID: {sprout_partuuid}")
     
     # Check mountpoint
     # For dry_run we might want to skip real checks or mock them
     if not config.dry_run:
-        mount_check = subprocess.run(["mountpoint", "-q", "/mnt"], check=False)
-        if mount_check.returncode == 0:
-            log_func("/mnt is already mounted. Unmounting...")
-            cleanup_mount("/mnt", log_func)
+        # One mountinfo read serves both the check and the unmount; this also
+        # catches a leftover /mnt/efi when /mnt itself is not mounted
+        stale = mounts_under("/mnt")
+        if stale:
+            log_func(f"/mnt is already in use ({' '.join(stale)}). Unmounting...")
+            cleanup_mount("/mnt", log_func, stale)
 
     log_func("Creating filesystems...")
-    run(f"mkfs.btrfs -f -L SEED {config.seed_device}", shell=True)
-    run(f"mkfs.btrfs -f -L SPROUT {config.sprout_device}", shell=True)
-    
+    # The three devices are independent, so format them concurrently
+    # (unless parallel_mkfs is off, e.g. all partitions share one spinning disk)
+    mkfs_jobs = [
+        ("SEED", ["mkfs.btrfs", "-f", "-L", "SEED", config.seed_device]),
+        ("SPROUT", ["mkfs.btrfs", "-f", "-L", "SPROUT", config.sprout_device]),
+    ]
     if config.format_efi:
-        run(f"mkfs.fat -F 32 -n EFI {config.efi_device}", shell=True)
+        mkfs_jobs.append(("EFI", ["mkfs.fat", "-F", "32", "-n", "EFI", config.efi_device]))
     else:
         log_func(f"Skipping EFI format (Using existing {config.efi_device})")
 
+    run_parallel(mkfs_jobs, log_func, dry_run=config.dry_run, parallel=config.parallel_mkfs)
+    _efi_scan_cache.pop(config.efi_device, None)
+
     log_func("Filesystems created successfully.")
         
     # Initial Mount
-    run(f"mount -o subvol=/ {config.seed_device} /mnt", shell=True)
+    live(["mount", "-o", "subvol=/", config.seed_device, "/mnt"])
     
-    # Check for @ subvolume
-    if not config.dry_run:
-        subvol_list = run("btrfs subvolume list /mnt", shell=True, capture_output=True).stdout
-        if any(line.endswith(" @") or line.endswith("path @") for line in subvol_list.splitlines()):
-            run("btrfs subvolume delete /mnt/@", shell=True)
+    # Check for @ subvolume (a single lookup, /mnt is the top-level subvolume)
+    if os.path.isdir("/mnt/@") and not config.dry_run:
+        if btrfsutil:
+            btrfsutil.delete_subvolume("/mnt/@")
+        else:
+            live(["btrfs", "subvolume", "delete", "/mnt/@"])
         
-    run("btrfs su cr /mnt/@", shell=True)
+    # Make @ the default subvolume so every later mount lands in it without subvol=
+    if btrfsutil and not config.dry_run:
+        btrfsutil.create_subvolume("/mnt/@")
+        btrfsutil.set_default_subvolume("/mnt/@")
+    else:
+        live(["btrfs", "su", "cr", "/mnt/@"])
+        live(["btrfs", "subvolume", "set-default", "/mnt/@"])
     cleanup_mount("/mnt", log_func)
-    run(f"mount -o subvol=/@ {config.seed_device} /mnt", shell=True)
+    live(["mount", config.seed_device, "/mnt"])
     
     # Pacstrap
-    log_func(f"Installing packages: {' '.join(config.packages)}")
-    run(["pacstrap", "-K", "/mnt"] + config.packages)
-    run(f"mount -m {config.efi_device} /mnt/efi", shell=True)
-    
-    # fstab
+    # Drop duplicates (e.g. a custom list merged with the defaults), keeping order
+    packages = list(dict.fromkeys(config.packages))
+    log_func(f"Installing packages: {' '.join(packages)}")
+    pacstrap_opts = ["-K"]
+    pacstrap_conf = None
     if not config.dry_run:
-        with open("/mnt/etc/fstab", "w") as f:
-            subprocess.run(["genfstab", "-U", "/mnt"], stdout=f, check=True)
-    else:
-        log_func("[DRY RUN] Would generate fstab")
+        # Give pacstrap a tuned copy of the host's pacman.conf via -C
+        fd, pacstrap_conf = tempfile.mkstemp(prefix="pacstrap-", suffix=".conf")
+        os.close(fd)
+        enable_pacman_parallel("/etc/pacman.conf", pacstrap_parallel_downloads, dest=pacstrap_conf)
+        pacstrap_opts += ["-C", pacstrap_conf]
+    try:
+        # pacstrap stops option parsing at the root directory, so options go first
+        pacstrap = live(["pacstrap"] + pacstrap_opts + ["/mnt"] + packages, background=True)
+        try:
+            # The EFI mount only needs /mnt to be mounted, so do it while pacstrap downloads
+            if live(["mount", "-m", config.efi_device, "/mnt/efi"], check=False) != 0:
+                sys.exit(1)
+            wait_live_command(pacstrap, log_func)
+        except BaseException:
+            # Never leave pacstrap writing to /mnt after bailing out
+            stop_live_command(pacstrap, log_func)
+            raise
+    finally:
+        if pacstrap_conf:
+            os.unlink(pacstrap_conf)
+    if not config.dry_run:
+        enable_pacman_parallel("/mnt/etc/pacman.conf")
+    
+    # fstab is written once, after the sprout is added (see below); nothing in the
+    # chroot step reads it (mkinitcpio uses mkinitcpio.conf, grub-mkconfig probes /proc)
         
     # Chroot function
-    mkinitcpio_hooks = "base udev autodetect microcode modconf kms keyboard block btrfs filesystems"
     grub_options = f"--target=x86_64-efi --efi-directory=/efi --boot-directory=/boot --bootloader-id={config.bootloader_id}"
     
+    # Only commands that need the target environment run inside the chroot;
+    # plain file edits are done from the host by write_target_config()
     install_script = [
         "hwclock --systohc",
-        f"echo '{config.hostname}' > /etc/hostname",
-        "echo 'KEYMAP=us' > /etc/vconsole.conf",
-        "sed -i 's/^#en_US.UTF-8 UTF-8/en_US.UTF-8 UTF-8/' /etc/locale.gen",
         "locale-gen",
-        "echo 'LANG=en_US.UTF-8' > /etc/locale.conf",
-        f"ln -sf /usr/share/zoneinfo/{config.timezone} /etc/localtime",
-        f'sed -i "s/^HOOKS=.*/HOOKS=({mkinitcpio_hooks})/" /etc/mkinitcpio.conf',
-        f"echo 'root:{config.root_password}' | chpasswd",
         f"useradd -m -G wheel -s /usr/bin/bash {config.username}",
-        f"echo '{config.username}:{config.user_password}' | chpasswd",
-        f"echo '{config.username} ALL=(ALL:ALL) ALL' > /etc/sudoers.d/{config.username}",
+        # Reads both "user:password" lines from the script's stdin; must come after useradd
+        "chpasswd",
         "systemctl enable systemd-timesyncd",
         f"grub-install {grub_options}",
-        "echo 'GRUB_DISABLE_OS_PROBER=false' >> /etc/default/grub",
         "grub-mkconfig -o /boot/grub/grub.cfg",
-        f"sed -i 's/root=UUID=[A-Fa-f0-9-]*/root=PARTUUID={sprout_partuuid}/g' /boot/grub/grub.cfg",
         "passwd -l root",
         "mkinitcpio -P"
     ]
     
+    if not config.dry_run:
+        write_target_config(config, "/mnt")
+    else:
+        log_func("[DRY RUN] Would write hostname, locale, timezone, sudoers, mkinitcpio and grub config")
+
     full_script = "\n".join(install_script)
     # arch-chroot /mnt /usr/bin/bash -c "$cmd"
     # We pass the full script as one argument to bash -c
-    run(["arch-chroot", "/mnt", "/usr/bin/bash", "-c", full_script])
+    # Passwords go in via stdin so they never show up in a process's argv
+    # Built in one allocation: chained + would leave unwiped intermediate copies
+    passwords = bytearray().join((b"root:", config.root_password, b"\n",
+                                  config.username.encode(), b":", config.user_password, b"\n"))
+    try:
+        live(["arch-chroot", "/mnt", "/usr/bin/bash", "-c", full_script], input=passwords)
+    finally:
+        for buf in (passwords, config.root_password, config.user_password):
+            buf[:] = bytes(len(buf))
+
+    if not config.dry_run:
+        rewrite_file("/mnt/boot/grub/grub.cfg", r"root=UUID=[A-Fa-f0-9-]*", f"root=PARTUUID={sprout_partuuid}")
+    else:
+        log_func("[DRY RUN] Would point grub.cfg at the sprout PARTUUID")
     
-    # Give processes a moment to release handles (e.g. gpg-agent)
-    time.sleep(2)
+    # Wait for leftover processes (e.g. gpg-agent) to release handles
+    if not config.dry_run:
+        wait_for_chroot_exit("/mnt")
     
     # Final cleanup
     log_func("--- Finalizing Seed/Sprout setup ---")
     cleanup_mount("/mnt", log_func)
     
-    log_func(f"Converting {config.seed_device} to a seed device...")
-    run(f"btrfstune -S 1 {config.seed_device}", shell=True)
-    
-    log_func("Mounting seed device to add sprout...")
-    run(f"mount -o subvol=/@ {config.seed_device} /mnt", shell=True)
-    
-    log_func(f"Adding {config.sprout_device} as sprout device...")
-    run(f"btrfs device add -f {config.sprout_device} /mnt", shell=True)
-    
+    # These steps must stay strictly ordered: btrfstune rewrites the superblock of an
+    # unmounted device, and the sprout can only be added once the seed flag is set.
+    # They run as one bash script; `set -e` stops at the first failure.
+    finalize_script = shell_script([
+        f"Converting {config.seed_device} to a seed device...",
+        ["btrfstune", "-S", "1", config.seed_device],
+        "Mounting seed device to add sprout...",
+        ["mount", config.seed_device, "/mnt"],
+        f"Adding {config.sprout_device} as sprout device...",
+        ["btrfs", "device", "add", "-f", config.sprout_device, "/mnt"],
+    ])
+    live(["bash", "-c", finalize_script])
+
+    # The sprout is already added at this point, so a busy /mnt must not abort the
+    # install; cleanup_mount kills any holders and retries
     log_func("Unmounting and remounting sprout device...")
     cleanup_mount("/mnt", log_func)
-    run(f"mount -o subvol=/@ {config.sprout_device} /mnt", shell=True)
-    
+    live(["mount", config.sprout_device, "/mnt"])
     log_func("Mounting EFI partition...")
-    run(f"mount -m {config.efi_device} /mnt/efi", shell=True)
+    live(["mount", "-m", config.efi_device, "/mnt/efi"])
     
     log_func("Generating final fstab with PARTUUIDs...")
     if not config.dry_run:
@@ -225,8 +716,8 @@ def perform_installation(config: InstallConfig, log_func=print):
     log_func("#                   INSTALLATION COMPLETE                      #")
     log_func("################################################################\n")
 
-def select_option(options, prompt_text, default_val=None):
-    """Generic selection loop"""
+def select_option(options, prompt_text, default_idx=1):
+    """Generic selection loop. default_idx is the 1-based option picked on empty input."""
     if not options:
         print("No options available!")
         sys.exit(1)
@@ -239,16 +730,6 @@ def select_option(options, prompt_text, default_val=None):
             display = opt['raw']
             
         print(f"{i + 1}) {display}")
-
-    default_idx = 1
-    if default_val:
-        for i, opt in enumerate(options):
-            val_to_check = opt['name'] if isinstance(opt, dict) and 'name' in opt else \
-                           (opt['path'] if isinstance(opt, dict) and 'path' in opt else str(opt))
-            # Check prefix match like input script
-            if str(val_to_check).startswith(default_val):
-                default_idx = i + 1
-                break
     
     while True:
         try:
@@ -257,15 +738,73 @@ def select_option(options, prompt_text, default_val=None):
             sys.exit(1)
             
         if not choice:
-            choice = str(default_idx)
+            return options[default_idx - 1]
         
-        if choice.isdigit():
+        try:
             idx = int(choice)
-            if 1 <= idx <= len(options):
-                return options[idx - 1]
+        except ValueError:
+            print("Invalid selection.")
+            continue
+        if 1 <= idx <= len(options):
+            return options[idx - 1]
         
         print("Invalid selection.")
 
+def _unescape_mountinfo(field):
+    # mountinfo escapes spaces, tabs, newlines and backslashes as \ooo octal
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+def read_mountinfo():
+    """Returns (mount_point, source) pairs for every entry in /proc/self/mountinfo."""
+    mounts = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            fields = line.split()
+            # Optional fields end with a lone "-", followed by fstype and source
+            sep = fields.index("-", 6)
+            mounts.append((_unescape_mountinfo(fields[4]), _unescape_mountinfo(fields[sep + 2])))
+    return mounts
+
+def mounts_under(root):
+    """Returns the mount points at or below root, in mount order."""
+    prefix = root.rstrip("/") + "/"
+    return [mount_point for mount_point, _ in read_mountinfo()
+            if mount_point == root or mount_point.startswith(prefix)]
+
+def mounted_devices():
+    """Returns the resolved paths of all block devices that are currently mounted."""
+    return {os.path.realpath(source) for _, source in read_mountinfo() if source.startswith("/dev/")}
+
+def check_target_device(path, mounted):
+    """
+    Returns a reason why path must not be formatted, or None if it looks safe.
+    mounted is the set returned by mounted_devices().
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        return f"{path}: {e.strerror}"
+    if not stat.S_ISBLK(st.st_mode):
+        return f"{path} is not a block device"
+    if not os.access(path, os.W_OK):
+        return f"{path} is not writable"
+    if os.path.realpath(path) in mounted:
+        return f"{path} is currently mounted"
+    return None
+
+def read_password(label):
+    """
+    Prompts for a password twice until both entries match and are non-empty.
+    Returns a bytearray so it can be wiped once it has been used.
+    """
+    while True:
+        p1 = getpass.getpass(f"{label}: ")
+        p2 = getpass.getpass(f"Confirm {label}: ")
+        if p1 and hmac.compare_digest(p1.encode(), p2.encode()):
+            # The str copies returned by getpass can't be wiped; dropping them is best effort
+            return bytearray(p1.encode())
+        print("Passwords do not match or are empty. Try again.")
+
 def main():
     # Helper defaults
     current_disk_default = "/dev/vda"
@@ -273,6 +812,12 @@ def main():
     sprout_default = "/dev/vda2"
     efi_default = "/dev/vda3"
     
+    # Fail fast, before the user spends time on prompts
+    try:
+        check_dependencies(print)
+    except RuntimeError:
+        sys.exit(2)
+    
     # 1. Select Disk
     print("Available storage disks:")
     disks = get_disks()
@@ -280,10 +825,14 @@ def main():
         print("No disks found!")
         sys.exit(1)
         
-    choice = select_option(disks, "Select a disk to choose partitions from", current_disk_default)
+    # Prefix match like the input script
+    disk_default_idx = next((i for i, d in enumerate(disks) if d['name'].startswith(current_disk_default)), 0) + 1
+    choice = select_option(disks, "Select a disk to choose partitions from", disk_default_idx)
     selected_disk = choice['name']
     
     # 2. Select Partitions
+    mounted = mounted_devices()
+
     def select_part(header, prompt, current_val):
         print(f"\n{header}")
         parts = get_partitions(selected_disk)
@@ -291,7 +840,12 @@ def main():
             print(f"No partitions found on {selected_disk}!")
             sys.exit(1)
         
-        choice = select_option(parts, prompt, current_val)
+        default_idx = next((i for i, p in enumerate(parts) if p['path'].startswith(current_val)), 0) + 1
+        choice = select_option(parts, prompt, default_idx)
+        problem = check_target_device(choice['path'], mounted)
+        if problem:
+            print(f"Error: {problem}")
+            sys.exit(1)
         return choice['path']
 
     seed_device = select_part("--- Select Seed Partition ---", "Seed device: ", seed_default)
@@ -305,9 +859,9 @@ def main():
     
     # Packages
     pkg_input = input("Enter packages to install (space-separated): ").strip()
-    packages = pkg_input.split() if pkg_input else list(default_packages)
+    packages = tuple(pkg_input.split()) if pkg_input else default_packages
     
-    if packages == default_packages:
+    if packages is default_packages:
         print(f"No packages specified. Defaulting to: {' '.join(packages)}")
     else:
         print(f"The following packages will be installed: {' '.join(packages)}")
@@ -319,24 +873,10 @@ def main():
     timezone = input("Enter timezone (default: Europe/Helsinki): ").strip() or "Europe/Helsinki"
     
     print("Set root password:")
-    root_pass = ""
-    while True:
-        p1 = getpass.getpass("Password: ")
-        p2 = getpass.getpass("Confirm Password: ")
-        if p1 == p2:
-            root_pass = p1
-            break
-        print("Passwords do not match. Try again.")
+    root_pass = read_password("Password")
         
     print(f"Set password for user {user}:")
-    user_pass = ""
-    while True:
-        p1 = getpass.getpass("Password: ")
-        p2 = getpass.getpass("Confirm Password: ")
-        if p1 == p2:
-            user_pass = p1
-            break
-        print("Passwords do not match. Try again.")
+    user_pass = read_password("Password")
 
     # Confirm
     resp = input("Confirm formatting and installation? (yes/no): ").lower()
@@ -363,7 +903,7 @@ def main():
     
     reboot_ans = input("Do you want to reboot now? (y/N): ").lower()
     if reboot_ans in ["y", "yes"]:
-        run_command("reboot", shell=True)
+        run_command(["reboot"])
     else:
         print("You can reboot manually by typing 'reboot'.")
 
@@ -1,6 +1,7 @@
 
 import sys
 import threading
+import queue
 from textual.app import App, ComposeResult
 from textual.containers import Container, Vertical, Horizontal
 from textual.widgets import Header, Footer, Button, Static, Label, Input, Select, DataTable, Log, ListItem, ListView
@@ -14,14 +15,23 @@ import os
 sys.path.append(os.getcwd())
 import z
 
+class InstallDone(Message):
+    """Posted by InstallWork when the installation thread finishes."""
+
 class InstallWork(threading.Thread):
-    def __init__(self, config, log_callback):
+    def __init__(self, config, notify_target):
         super().__init__()
         self.config = config
-        self.log_callback = log_callback
+        self.notify_target = notify_target
+        # Log lines are queued here and drained in batches on the UI thread
+        self.log_queue = queue.Queue()
 
     def run(self):
-        z.perform_installation(self.config, log_func=self.log_callback)
+        try:
+            z.perform_installation(self.config, log_func=self.log_queue.put)
+        finally:
+            # post_message is thread-safe; wakes the UI once instead of polling
+            self.notify_target.post_message(InstallDone())
 
 class DiskSelectScreen(Screen):
     """Screen to select the target disk."""
@@ -39,19 +49,25 @@ class DiskSelectScreen(Screen):
         table = self.query_one(DataTable)
         table.cursor_type = "row"
         table.add_columns("Name", "Size", "Model")
-        
-        disks = z.get_disks()
-        self.disks_data = disks # keep reference
-        
-        rows = []
-        for d in disks:
-            rows.append((d['name'], d['size'], d['model']))
-        
-        table.add_rows(rows)
+        table.loading = True
+        self.disk_names = []
+        self.load_disks()
+
+    @work(thread=True, exclusive=True)
+    def load_disks(self) -> None:
+        # lsblk runs off the UI thread so the screen paints immediately
+        columns = z.get_disk_columns()
+        self.app.call_from_thread(self.populate_disks, *columns)
+
+    def populate_disks(self, names, sizes, models) -> None:
+        table = self.query_one(DataTable)
+        self.disk_names = names # keep reference
+        table.add_rows(zip(names, sizes, models))
+        table.loading = False
 
     def on_data_table_row_selected(self, event: DataTable.RowSelected) -> None:
         table = self.query_one(DataTable)
-        self.app.selected_disk = self.disks_data[event.cursor_row]['name']
+        self.app.selected_disk = self.disk_names[event.cursor_row]
         self.query_one("#btn_next").disabled = False
         self.app.push_screen("partition_select")
 
@@ -202,7 +218,7 @@ class PackageScreen(Screen):
     def on_button_pressed(self, event: Button.Pressed) -> None:
          if event.button.id == "btn_next":
              pkg_str = self.query_one("#inp_packages").value
-             self.app.packages = pkg_str.split() if pkg_str else z.default_packages
+             self.app.packages = tuple(pkg_str.split()) if pkg_str else z.default_packages
              self.app.push_screen("summary")
 
 class SummaryScreen(Screen):
@@ -259,8 +275,8 @@ class InstallScreen(Screen):
             hostname=self.app.conf_hostname,
             username=self.app.conf_username,
             timezone=self.app.conf_timezone,
-            root_password=self.app.conf_root_pass,
-            user_password=self.app.conf_user_pass,
+            root_password=bytearray(self.app.conf_root_pass.encode()),
+            user_password=bytearray(self.app.conf_user_pass.encode()),
     # ... (skipping inside method)
             packages=self.app.packages,
             dry_run=False,
@@ -268,11 +284,30 @@ class InstallScreen(Screen):
             bootloader_id=self.app.bootloader_id
         )
         
-        self.worker = InstallWork(config, self.write_log)
+        self.worker = InstallWork(config, self)
         self.worker.start()
-        self.timer = self.set_interval(0.5, self.check_done)
+        self.drain_timer = self.set_interval(0.1, self.drain_log)
+
+    def drain_log(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.worker.log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if lines:
+            self.query_one(Log).write_lines(lines)
+
+    @on(InstallDone)
+    def install_done(self) -> None:
+        self.drain_timer.stop()
+        self.drain_log()
+        self.query_one(Log).write_line("Installation process finished.")
+        self.query_one("#btn_done").disabled = False
 
-    # ... (rest of InstallScreen)
+    def on_button_pressed(self, event: Button.Pressed) -> None:
+        if event.button.id == "btn_done":
+            self.app.exit()
 
 class ZInstallerApp(App):
     CSS = """
@@ -334,7 +369,7 @@ class ZInstallerApp(App):
     conf_timezone = None
     conf_root_pass = None
     conf_user_pass = None
-    packages = []
+    packages = ()
 
     SCREENS = {
         "disk_select": DiskSelectScreen,
@@ -346,6 +381,8 @@ class ZInstallerApp(App):
     }
 
     def on_mount(self) -> None:
+        # DiskSelectScreen loads the block device tree in the background;
+        # the partition screen reuses the same cached tree
         self.push_screen("disk_select")
 
 if __name__ == "__main__":